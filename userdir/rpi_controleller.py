@@ -1,16 +1,124 @@
 #!/usr/bin/env python
 
 import os
-import time
 import argparse
 import select
-import yaml
 import datetime
+import io
+import string
+import tempfile
+import functools
+import concurrent.futures
+import threading
 
-import paramiko
-import scp
+# paramiko, scp, yaml and xmlrpc are imported where they are used,
+# so that importing this module does not load the ssh/crypto libraries
+
+
+@functools.lru_cache(maxsize=32)
+def _load_settings(path, mtime):
+    """load ros settings file (cached while the file is unchanged)
+    Args:
+        path  (str) : ros settings file path
+        mtime (int) : modification time of the file, used as cache key
+    """
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+# supervisor fault code returned when stopping a process that is not running
+_SV_NOT_RUNNING = 70
+
+# seconds to wait for the remote settings directory to be created in send_settings
+_PREPARE_TIMEOUT = 10.0
+
+# ssh connections shared between controllers of the same (hostname, username)
+_CLIENT_POOL = {}
+_REFCOUNT = {}
+_POOL_LOCK = threading.Lock()
+
+
+def _is_active(client):
+    """true if client is connected and its transport is still alive
+    Args:
+        client (paramiko.SSHClient) : client or None
+    """
+    transport = client.get_transport() if client is not None else None
+    return transport is not None and transport.is_active()
+
+
+def _acquire_client(hostname, username, password):
+    """get a connected SSHClient, reusing a live one from the pool if possible
+    Args:
+        hostname (str) : robot ip address
+        username (str) : login user
+        password (str) : login password
+    """
+    key = (hostname, username)
+    with _POOL_LOCK:
+        client = _CLIENT_POOL.get(key)
+        if _is_active(client):
+            _REFCOUNT[key] = _REFCOUNT.get(key, 0) + 1
+            return client
+    # connect without holding the lock so that different robots can connect in parallel
+    import paramiko
+    # prefer AES-GCM when the installed paramiko offers it (5.0 or later); older versions keep their defaults.
+    # if the robot's sshd does not accept GCM, connect again with the default cipher list
+    ciphers = paramiko.Transport._preferred_ciphers
+    # IncompatiblePeer does not exist in old paramiko, which never tries GCM only
+    incompatible_peer = getattr(paramiko.ssh_exception, 'IncompatiblePeer', ())
+    connect_options_list = [{}]
+    if any('-gcm@' in c for c in ciphers):
+        connect_options_list.insert(0, {'disabled_algorithms': {'cipher': [c for c in ciphers if '-gcm@' not in c]}})
+    for i, connect_options in enumerate(connect_options_list):
+        new_client = paramiko.SSHClient()
+        new_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            new_client.connect(hostname=hostname, port=22,
+                               username=username, password=password, compress=True, **connect_options)
+            break
+        except incompatible_peer:
+            new_client.close()
+            if i == len(connect_options_list) - 1:
+                raise
+    with _POOL_LOCK:
+        client = _CLIENT_POOL.get(key)
+        if _is_active(client):
+            # another thread connected to the same robot first
+            unused_client = new_client
+        else:
+            # replace a stale client (or nothing)
+            unused_client = client
+            client = new_client
+            _CLIENT_POOL[key] = client
+        _REFCOUNT[key] = _REFCOUNT.get(key, 0) + 1
+    if unused_client is not None:
+        unused_client.close()
+    return client
+
+
+def _release_client(hostname, username):
+    """release a client taken by _acquire_client, closing it when no longer used
+    Args:
+        hostname (str) : robot ip address
+        username (str) : login user
+    """
+    key = (hostname, username)
+    with _POOL_LOCK:
+        count = _REFCOUNT.get(key, 0) - 1
+        if count > 0:
+            _REFCOUNT[key] = count
+            return
+        _REFCOUNT.pop(key, None)
+        client = _CLIENT_POOL.pop(key, None)
+    if client is not None:
+        client.close()
 
-from xmlrpc.client import ServerProxy
 
 # 参考資料
 #
@@ -21,34 +129,75 @@ from xmlrpc.client import ServerProxy
 
 
 class RPIController:
-    def __init__(self, robotname, ros_settings_path):
+    # contents of run_robot.sh executed by supervisor on the raspberry pi
+    _RUN_ROBOT_TEMPLATE = string.Template(
+        'trap "trap - SIGTERM && kill -- -$$$$" SIGINT SIGTERM EXIT\n'
+        '$source_command && roslaunch $launch_file dynamixel_settings:=$dynamixel_settings controller_settings:=$controller_settings namespace:=$namespace sensor_config_path:=$sensor_config_path use_dynamixel:=$use_dynamixel use_sensor:=$use_sensor use_camera:=$use_camera & \n'
+        'wait\n')
+
+    def __init__(self, robotname, ros_settings_path, export_env=True):
         """CPS Controller for raspberry pi
         Args:
             robotname (str): robotname
             ros_settings_path (str): ros settings file path
+            export_env (bool): true if set ROS_* variables in os.environ (needed by RobotInterface in this process)
         """
-        with open(ros_settings_path, 'r') as f:
-            setting = yaml.safe_load(f)
+        ros_settings_path = os.path.abspath(ros_settings_path)
+        setting = _load_settings(ros_settings_path, os.stat(ros_settings_path).st_mtime_ns)
         self.hostname = setting['robot_ip_addr']
         self.username = setting['username']
         self.password = setting['password']
         self.robotname = robotname
-        os.environ['ROS_MASTER_URI'] = 'http://{}:11311'.format(setting['rosmaster_ip_addr'] if 'rosmaster_ip_addr' in setting else setting['robot_ip_addr'])
-        os.environ['ROS_IP'] = setting['host_ip_addr']
-        os.environ['ROS_HOSTNAME'] = setting['host_ip_addr']
+        # ros environment for this robot. apply with os.environ.update(self.env) before creating RobotInterface
+        # when this controller was created with export_env=False
+        self.env = {
+            'ROS_MASTER_URI': 'http://{}:11311'.format(setting['rosmaster_ip_addr'] if 'rosmaster_ip_addr' in setting else setting['robot_ip_addr']),
+            'ROS_IP': setting['host_ip_addr'],
+            'ROS_HOSTNAME': setting['host_ip_addr'],
+        }
+        if export_env:
+            os.environ.update(self.env)
 
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client.connect(hostname=self.hostname, port=22,
-                            username=self.username, password=self.password)
+        self.client = _acquire_client(self.hostname, self.username, self.password)
 
         self.source_command = 'source /home/{}/.ros_rc && source /home/{}/catkin_ws/devel/setup.bash'.format(
             self.username, self.username)
         self.ssh_stds = {}
+
+        # remote paths which only depend on username
+        self._settings_root = '/home/{}/cps_settings'.format(self.username)
+        self._latest_dir = '{}/latest_settings'.format(self._settings_root)
+        self._launch_prefix = '/home/{}/cps_rpi/launch'.format(self.username)
+        self._launch_file = '{}/run_robot.launch'.format(self._launch_prefix)
+        self._load_sensor_config_path = '{}/all_sensor.yaml'.format(self._latest_dir)
+        self._load_dynamixel_config_path = '{}/config.yaml'.format(self._latest_dir)
+        self._load_controller_config_path = '{}/controller_config.yaml'.format(self._latest_dir)
         
         # for supervisor
-        self.sv_server = None
+        from xmlrpc.client import ServerProxy
+        # one proxy per controller so that its transport keeps the http connection alive between calls
+        self.sv_server = ServerProxy('http://{}:{}@{}:9999/RPC2'.format(self.username, self.password, self.hostname))
         self.sv_service_name = 'run_robot'
+        self.sv_started = False
+
+    @staticmethod
+    def parallel(controllers, fn_name, *args, **kwargs):
+        """call the same method of several controllers in parallel
+        Args:
+            controllers (list of RPIController) : controllers (one raspberry pi each)
+            fn_name     (str) : method name (e.g. 'send_settings', 'start_robot')
+            args, kwargs      : arguments passed to the method
+        Returns:
+            list : return values, in the order of controllers
+        Note:
+            send_settings names its directory by the current second, so controllers
+            must target different raspberry pis (or different users).
+        """
+        if len(controllers) == 0:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(controllers)) as executor:
+            futures = [executor.submit(getattr(c, fn_name), *args, **kwargs) for c in controllers]
+            return [f.result() for f in futures]
 
     # for supervisor
     def send_settings(self, use_actuator=True, use_sensor=True, use_camera=False, sensor_config_path=None, dynamimxel_config=None, controller_config=None, send_files=[]):
@@ -63,60 +212,89 @@ class RPIController:
             send_files   (list of str) : send file list
         """
         date_string = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-        dist_dir = '/home/{}/cps_settings/{}'.format(
-            self.username, date_string)
-        latest_dir = '/home/{}/cps_settings/latest_settings'.format(
-            self.username)
-
-        put_sensor_config_path = '{}/all_sensor.yaml'.format(dist_dir)
-        put_dynamixel_config_path = '{}/config.yaml'.format(dist_dir)
-        put_controller_config_path = '{}/controller_config.yaml'.format(
-            dist_dir)
-
-        load_sensor_config_path = '{}/all_sensor.yaml'.format(latest_dir)
-        load_dynamixel_config_path = '{}/config.yaml'.format(latest_dir)
-        load_controller_config_path = '{}/controller_config.yaml'.format(latest_dir)
-        
+        dist_dir = '{}/{}'.format(self._settings_root, date_string)
+
         use_dynamixel_str = 'true' if use_actuator else 'false'
         use_sensor_str = 'true' if use_sensor else 'false'
         use_camera_str = 'true' if use_camera else 'false'
 
-        make_shell = 'echo -e \'trap \\"trap - SIGTERM && kill -- -\$\$\\" SIGINT SIGTERM EXIT\\n{} && roslaunch /home/{}/cps_rpi/launch/run_robot.launch dynamixel_settings:={} controller_settings:={} namespace:={} sensor_config_path:={} use_dynamixel:={} use_sensor:={} use_camera:={} & \\nwait\\n\' > {}/run_robot.sh'.format(self.source_command, self.username,
-                                                                                                                                                                                                                                                                        load_dynamixel_config_path, load_controller_config_path,
-                                                                                                                                                                                                                                                                        self.robotname, load_sensor_config_path, use_dynamixel_str, use_sensor_str, use_camera_str, dist_dir)
-        command = 'bash -lc "mkdir -p {} && rm -f {} && ln -s {} {} && {}"'.format(
-            dist_dir, latest_dir, dist_dir, latest_dir, make_shell)
-        self.ssh_stds["operation"] = self.client.exec_command(
-            command, get_pty=True)
-        time.sleep(2)
-        with scp.SCPClient(self.client.get_transport()) as scpc:
-            if sensor_config_path is not None:
-                scpc.put(sensor_config_path, put_sensor_config_path)
-            if dynamimxel_config is not None:
-                scpc.put(dynamimxel_config, put_dynamixel_config_path)
-            if controller_config is not None:
-                scpc.put(controller_config, put_controller_config_path)
-            for sendfile in send_files:
-                scpc.put(sendfile, '{}/{}'.format(dist_dir, os.path.basename(sendfile)))
-                
+        run_robot_shell = self._RUN_ROBOT_TEMPLATE.substitute(
+            source_command=self.source_command, launch_file=self._launch_file,
+            dynamixel_settings=self._load_dynamixel_config_path, controller_settings=self._load_controller_config_path,
+            namespace=self.robotname, sensor_config_path=self._load_sensor_config_path,
+            use_dynamixel=use_dynamixel_str, use_sensor=use_sensor_str, use_camera=use_camera_str)
+        command = 'mkdir -p {} && ln -sfn {} {}'.format(
+            dist_dir, dist_dir, self._latest_dir)
+        self.ssh_stds["operation"] = self.client.exec_command(command)
+        # merge stderr into stdout so only one stream has to be drained
+        self.ssh_stds["operation"][1].channel.set_combine_stderr(True)
+        # wait until dist_dir exists before uploading into it
+        channel = self.ssh_stds["operation"][1].channel
+        if not channel.status_event.wait(_PREPARE_TIMEOUT):
+            channel.close()
+            raise RuntimeError('failed to prepare {} : timed out after {} s'.format(
+                dist_dir, _PREPARE_TIMEOUT))
+        if channel.recv_exit_status() != 0:
+            raise RuntimeError('failed to prepare {} : {}'.format(
+                dist_dir, self.ssh_stds["operation"][1].read().decode('utf-8', errors='replace').strip()))
+        import scp
+        # config files are renamed on the remote side, so link them under their remote names
+        # and send everything with a single multi-file put
+        with tempfile.TemporaryDirectory() as link_dir:
+            put_files = []
+            for local_path, remote_name in ((sensor_config_path, 'all_sensor.yaml'),
+                                            (dynamimxel_config, 'config.yaml'),
+                                            (controller_config, 'controller_config.yaml')):
+                if local_path is not None:
+                    link_path = os.path.join(link_dir, remote_name)
+                    os.symlink(os.path.abspath(local_path), link_path)
+                    put_files.append(link_path)
+            put_files.extend(send_files)
+            # remote paths are built here from username and date only, so they need no shell quoting
+            with scp.SCPClient(self.client.get_transport(), socket_timeout=30.0, sanitize=False) as scpc:
+                # putfo and put each open their own 'scp -t' channel on the shared transport
+                scpc.putfo(io.BytesIO(run_robot_shell.encode()), '{}/run_robot.sh'.format(dist_dir), mode='0755')
+                if put_files:
+                    scpc.put(put_files, remote_path=dist_dir)
+
     def start_robot(self):
         """start robot's program via Supervisor
+        stop and start are sent in one request. stop of a program that is not running
+        (NOT_RUNNING) is ignored. any other fault is raised, but note that supervisor
+        has already run startProcess in the same request, so the program may be running.
         """
-        self.sv_server = ServerProxy('http://{}:{}@{}:9999/RPC2'.format(self.username, self.password, self.hostname))
-        # if robot's program are alreday running, stop program before start.
-        if self.sv_server.supervisor.getProcessInfo(self.sv_service_name)['statename'] == 'RUNNING':
-            self.sv_server.supervisor.stopProcess(self.sv_service_name, True)    
-        self.sv_server.supervisor.startProcess(self.sv_service_name, True)
+        from xmlrpc.client import MultiCall, Fault
+        mc = MultiCall(self.sv_server)
+        mc.supervisor.stopProcess(self.sv_service_name, True)
+        mc.supervisor.startProcess(self.sv_service_name, True)
+        results = mc()
+        # indexing the MultiCallIterator returns the call's result, or re-raises its Fault
+        try:
+            results[0]  # stopProcess
+        except Fault as e:
+            if e.faultCode != _SV_NOT_RUNNING:
+                raise
+        results[1]  # startProcess
+        self.sv_started = True
 
     def stop_robot(self):
         """stop robot's program via Supervisor
         """
         self.sv_server.supervisor.stopProcess(self.sv_service_name, True)
+        self.sv_started = False
 
     # destructor
     def __del__(self):
-        self.client.close()
-        # for suppervisor
-        if self.sv_server is not None:
-            self.stop_robot()
-        time.sleep(1)
+        # errors here come from an already stopped program or from interpreter shutdown
+        # (module globals set to None), neither of which can be handled in a destructor
+        try:
+            # for suppervisor
+            if getattr(self, 'sv_started', False):
+                self.stop_robot()
+        except Exception:
+            pass
+        try:
+            if getattr(self, 'client', None) is not None:
+                _release_client(self.hostname, self.username)
+        except Exception:
+            pass